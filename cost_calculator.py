@@ -3,80 +3,376 @@ ETL Pipeline Cost Calculator
 Calculates costs per datafeed for S3 and Lambda services
 """
 
+import asyncio
+import csv
+import os
+import re
+import string
+import threading
+import time
 import boto3
-from datetime import datetime, timedelta
-from typing import Dict, List
+from array import array
+from botocore.config import Config
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Deque, Dict, List, Optional, Set, Tuple
 import yaml
 
 
+# GetMetricData accepts at most 500 queries per request
+MAX_METRIC_DATA_QUERIES = 500
+
+# Standard CloudWatch periods; sums use the coarsest one that fits the window
+METRIC_PERIODS = (60, 300, 900, 3600, 21600, 86400)
+
+# CloudWatch metrics fetched per refresh, by query Id suffix. Each entry is a
+# single statistic; dimension values are templates filled from the config of
+# the datafeed or function the metric is scoped to. Entries under the
+# top-level `metrics` config key override these or add new ones.
+DEFAULT_METRICS = {
+    'put': {
+        'scope': 'datafeed', 'namespace': 'AWS/S3', 'name': 'PutRequests', 'stat': 'Sum',
+        'dimensions': {'BucketName': '{bucket}', 'FilterId': '{datafeed}'}
+    },
+    'get': {
+        'scope': 'datafeed', 'namespace': 'AWS/S3', 'name': 'GetRequests', 'stat': 'Sum',
+        'dimensions': {'BucketName': '{bucket}', 'FilterId': '{datafeed}'}
+    },
+    'inv': {
+        'scope': 'function', 'namespace': 'AWS/Lambda', 'name': 'Invocations', 'stat': 'Sum',
+        'dimensions': {'FunctionName': '{function}'}
+    },
+    'dur': {
+        'scope': 'function', 'namespace': 'AWS/Lambda', 'name': 'Duration', 'stat': 'Sum',
+        'dimensions': {'FunctionName': '{function}'}
+    }
+}
+
+# Template fields available to the dimensions of each metric scope
+METRIC_SCOPES = {
+    'datafeed': ('bucket', 'datafeed', 'prefix'),
+    'function': ('bucket', 'datafeed', 'function')
+}
+
+# Price applied to each summed metric, by query Id suffix:
+# (pricing section, price key, metric units the price is quoted per).
+# Duration is priced per GB of configured memory.
+METRIC_PRICES = {
+    'put': ('s3', 'put_request_per_1000', 1000),
+    'get': ('s3', 'get_request_per_1000', 1000),
+    'inv': ('lambda', 'request_per_million', 1_000_000),
+    'dur': ('lambda', 'duration_per_gb_second', 1000)
+}
+
+# Summed metrics are kept as hourly buckets so a refresh only fetches new hours
+HISTORY_PERIOD = 3600
+
+# Settled buckets fetched again each refresh to pick up late-ingested datapoints
+HISTORY_LATE_BUCKETS = 1
+
+# S3 storage metrics are published once a day, a few days covers the latest
+STORAGE_METRICS_LOOKBACK = timedelta(days=3)
+
+# BucketSizeBytes is only published per storage class, so the size is summed
+# over the classes holding object data to match the AllStorageTypes object count
+STORAGE_SIZE_TYPES = (
+    'StandardStorage', 'IntelligentTieringFAStorage', 'IntelligentTieringIAStorage',
+    'IntelligentTieringAAStorage', 'IntelligentTieringAIAStorage',
+    'IntelligentTieringDAAStorage', 'StandardIAStorage', 'OneZoneIAStorage',
+    'ReducedRedundancyStorage', 'GlacierInstantRetrievalStorage', 'GlacierStorage',
+    'GlacierStagingStorage', 'DeepArchiveStorage', 'DeepArchiveStagingStorage'
+)
+
+# Sources a datafeed can opt in to for its storage totals instead of listing.
+# S3 only publishes storage metrics per bucket, so 'bucket' fits a datafeed
+# whose prefix holds everything in the bucket.
+STORAGE_METRIC_SOURCES = ('bucket',)
+
+# Large prefixes are listed as concurrent key ranges split on these characters
+DEFAULT_PARTITION_CHARS = '0123456789abcdef'
+DEFAULT_LIST_FANOUT = 16
+
+# Worker threads the blocking boto3 calls of one refresh are spread across
+MAX_WORKERS = 32
+
+# libyaml's C parser when PyYAML was built with it
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# Storage size and Lambda memory rarely change between refreshes
+DEFAULT_CACHE_TTL_SECONDS = {
+    'storage': 600,
+    'lambda_memory': 3600
+}
+
+# Metric queries that return zero this many refreshes in a row are backed
+# off exponentially, skipping up to the max refreshes between checks
+DEFAULT_COLD_QUERY_THRESHOLD = 3
+DEFAULT_COLD_QUERY_MAX_SKIP = 16
+
+# One session and client config shared by every calculator in the process
+_SESSION = boto3.session.Session()
+_CLIENT_CONFIG = Config(
+    max_pool_connections=64,
+    retries={'mode': 'adaptive', 'max_attempts': 5},
+    tcp_keepalive=True
+)
+
+_CALCULATORS: Dict[str, 'CostCalculator'] = {}
+
+
+def get_calculator(config_path: str = 'config.yaml') -> 'CostCalculator':
+    """Return the process-wide CostCalculator for a config file"""
+    key = os.path.abspath(config_path)
+    if key not in _CALCULATORS:
+        _CALCULATORS[key] = CostCalculator(config_path)
+    return _CALCULATORS[key]
+
+
+@dataclass
+class CostSnapshot:
+    """Per-datafeed costs of one refresh, stored column-wise"""
+    names: List[str] = field(default_factory=list)
+    size_gb: array = field(default_factory=lambda: array('d'))
+    object_count: array = field(default_factory=lambda: array('q'))
+    monthly_storage_cost: array = field(default_factory=lambda: array('d'))
+    put_cost: array = field(default_factory=lambda: array('d'))
+    get_cost: array = field(default_factory=lambda: array('d'))
+    request_cost: array = field(default_factory=lambda: array('d'))
+    lambda_cost: array = field(default_factory=lambda: array('d'))
+    total_cost: array = field(default_factory=lambda: array('d'))
+    period_hours: int = 24
+    
+    COLUMNS = (
+        'size_gb', 'object_count', 'monthly_storage_cost', 'put_cost',
+        'get_cost', 'request_cost', 'lambda_cost', 'total_cost'
+    )
+    
+    @classmethod
+    def from_costs(cls, costs: List[Dict]) -> 'CostSnapshot':
+        """Build a snapshot from get_datafeed_costs() results"""
+        snapshot = cls()
+        snapshot.reset([d['datafeed'] for d in costs], costs[0]['period_hours'] if costs else 24)
+        for index, datafeed_costs in enumerate(costs):
+            snapshot.set_row(index, datafeed_costs)
+        return snapshot
+    
+    def reset(self, names: List[str], period_hours: int) -> None:
+        """Zero every column to one row per datafeed, ready to be filled in place"""
+        self.names = list(names)
+        self.period_hours = period_hours
+        for name in self.COLUMNS:
+            setattr(self, name, array(getattr(self, name).typecode, [0]) * len(self.names))
+    
+    def set_row(self, index: int, datafeed_costs: Dict) -> None:
+        """Fill one datafeed's columns from its get_datafeed_costs() result"""
+        s3_storage = datafeed_costs['s3_storage']
+        s3_requests = datafeed_costs['s3_requests']
+        self.size_gb[index] = s3_storage['size_gb']
+        self.object_count[index] = s3_storage['object_count']
+        self.monthly_storage_cost[index] = s3_storage['monthly_storage_cost']
+        self.put_cost[index] = s3_requests['put_cost']
+        self.get_cost[index] = s3_requests['get_cost']
+        self.request_cost[index] = s3_requests['total_request_cost']
+        self.lambda_cost[index] = datafeed_costs['lambda_total_cost']
+        self.total_cost[index] = datafeed_costs['total_cost']
+    
+    def __len__(self) -> int:
+        return len(self.names)
+    
+    def total(self) -> float:
+        """Total cost across all datafeeds"""
+        return sum(self.total_cost)
+    
+    def append_csv(self, path: str, timestamp: datetime) -> None:
+        """Append one row per datafeed to a CSV history file"""
+        write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if write_header:
+                writer.writerow(['timestamp', 'datafeed', *self.COLUMNS])
+            columns = [getattr(self, name) for name in self.COLUMNS]
+            stamp = timestamp.isoformat()
+            writer.writerows([stamp, name, *values] for name, *values in zip(self.names, *columns))
+
+
+def _load_metrics(entries: List[Dict]) -> Dict[str, Dict]:
+    """Merge configured metric definitions over the defaults and validate them"""
+    metrics = {key: dict(metric) for key, metric in DEFAULT_METRICS.items()}
+    for entry in entries:
+        entry = dict(entry)
+        key = str(entry.pop('key', ''))
+        if not re.fullmatch(r'[a-z][a-z0-9]*', key):
+            raise ValueError(f"Metric key {key!r} must be lowercase letters and digits")
+        metrics[key] = {**metrics.get(key, {}), **entry}
+    
+    for key, metric in metrics.items():
+        missing = {'scope', 'namespace', 'name', 'stat', 'dimensions'} - set(metric)
+        if missing:
+            raise ValueError(f"Metric {key!r} is missing {', '.join(sorted(missing))}")
+        if metric['scope'] not in METRIC_SCOPES:
+            raise ValueError(f"Metric {key!r} has unknown scope {metric['scope']!r}")
+        # Priced metrics are read back per datafeed or function by Id suffix
+        if key in METRIC_PRICES and metric['scope'] != DEFAULT_METRICS[key]['scope']:
+            raise ValueError(
+                f"Metric {key!r} is priced and must keep scope {DEFAULT_METRICS[key]['scope']!r}"
+            )
+        # One MetricStat per entry keeps each response to the single stat used,
+        # and that stat has to be Sum as values are added across hourly buckets
+        if metric['stat'] != 'Sum':
+            raise ValueError(
+                f"Metric {key!r} must request exactly one stat, Sum, got {metric['stat']!r}"
+            )
+        dimensions = metric['dimensions']
+        if not isinstance(dimensions, dict) or not all(
+            isinstance(name, str) and isinstance(template, str)
+            for name, template in dimensions.items()
+        ):
+            raise ValueError(f"Metric {key!r} dimensions must map names to string values")
+        for template in dimensions.values():
+            fields = {name for _, name, _, _ in string.Formatter().parse(template) if name}
+            unknown = fields - set(METRIC_SCOPES[metric['scope']])
+            if unknown:
+                raise ValueError(
+                    f"Metric {key!r} dimension uses unknown field(s) {', '.join(sorted(unknown))}"
+                )
+    
+    return metrics
+
+
 class CostCalculator:
     def __init__(self, config_path: str = 'config.yaml'):
         with open(config_path, 'r') as f:
-            self.config = yaml.safe_load(f)
+            self.config = yaml.load(f, Loader=_YAML_LOADER)
         
         self.region = self.config['region']
-        self.s3_client = boto3.client('s3', region_name=self.region)
-        self.cloudwatch = boto3.client('cloudwatch', region_name=self.region)
-        self.lambda_client = boto3.client('lambda', region_name=self.region)
+        self.list_fanout = self.config['s3'].get('list_fanout', DEFAULT_LIST_FANOUT)
+        # Key ranges of every datafeed share one listing pool, so at most the
+        # listing threads plus the refresh workers fetching first pages hit S3
+        # at once and none of them queue on the connection pool
+        self._list_executor = ThreadPoolExecutor(
+            max_workers=self.list_fanout, thread_name_prefix='s3-list'
+        )
+        s3_config = _CLIENT_CONFIG.merge(Config(
+            max_pool_connections=max(
+                _CLIENT_CONFIG.max_pool_connections, self.list_fanout + MAX_WORKERS
+            )
+        ))
+        self.s3_client = _SESSION.client('s3', region_name=self.region, config=s3_config)
+        self.cloudwatch = _SESSION.client('cloudwatch', region_name=self.region, config=_CLIENT_CONFIG)
+        self.lambda_client = _SESSION.client('lambda', region_name=self.region, config=_CLIENT_CONFIG)
         
         self.pricing = self.config['pricing']
+        self.metrics = _load_metrics(self.config.get('metrics', []))
+        
+        self.cache_ttl = {
+            **DEFAULT_CACHE_TTL_SECONDS,
+            **self.config.get('monitoring', {}).get('cache_ttl_seconds', {})
+        }
+        self._storage_cache: Dict[Tuple[str, str], Tuple[float, Dict]] = {}
+        self._memory_cache: Dict[str, Tuple[float, int]] = {}
+        
+        monitoring = self.config.get('monitoring', {})
+        self.cold_query_threshold = monitoring.get(
+            'cold_query_threshold', DEFAULT_COLD_QUERY_THRESHOLD
+        )
+        self.cold_query_max_skip = monitoring.get(
+            'cold_query_max_skip', DEFAULT_COLD_QUERY_MAX_SKIP
+        )
+        self._zero_streaks: Dict[str, int] = {}
+        self._skips_left: Dict[str, int] = {}
+        
+        # Queries only depend on the static config, so they are built once and
+        # each refresh just supplies the time window
+        self._unit_prices = {
+            suffix: (units, self.pricing[section][price_key])
+            for suffix, (section, price_key, units) in METRIC_PRICES.items()
+        }
+        self._metric_queries: Dict[int, List[Dict]] = {}
+        self._storage_queries = [
+            self._storage_metric_queries(f'd{i}', datafeed)
+            for i, datafeed in enumerate(self.config['s3']['datafeeds'])
+        ]
+        self._funcs_by_feed: Dict[str, List[Tuple[int, Dict]]] = defaultdict(list)
+        for j, func in enumerate(self.config['lambda']['functions']):
+            self._funcs_by_feed[func['datafeed']].append((j, func))
+        self._collect_metric_queries(HISTORY_PERIOD)
+        
+        # Hourly buckets per query Id for the sliding lookback window
+        self._metric_history: Dict[str, Deque[Tuple[datetime, float]]] = {}
+        self._history_fetched: Dict[str, datetime] = {}
+        self._history_hours: Optional[int] = None
+        self._history_lock = threading.Lock()
     
-    def get_s3_storage_cost(self, datafeed: Dict) -> Dict:
+    def get_s3_storage_cost(self, datafeed: Dict,
+                            storage_metrics: Optional[Dict[str, float]] = None,
+                            query_id: str = 'd0') -> Dict:
         """Calculate S3 storage costs for a datafeed"""
         bucket = self.config['s3']['bucket']
         prefix = datafeed['prefix']
         
-        total_size_bytes = 0
-        object_count = 0
+        # Callers passing storage_metrics have already found the cache stale
+        if storage_metrics is None:
+            cached = self._cached_storage_cost(datafeed)
+            if cached is not None:
+                return cached
         
-        paginator = self.s3_client.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    total_size_bytes += obj['Size']
-                    object_count += 1
+        # Prefer daily storage metrics for datafeeds that opted in, list the
+        # objects otherwise or when none are published
+        if storage_metrics is None:
+            _, end_time = self._window(0)
+            storage_metrics = self._get_storage_metrics(
+                self._storage_metric_queries(query_id, datafeed), end_time
+            )
+        
+        class_sizes = [
+            storage_metrics[f'{query_id}_size{k}']
+            for k in range(len(STORAGE_SIZE_TYPES))
+            if f'{query_id}_size{k}' in storage_metrics
+        ]
+        total_size_bytes = sum(class_sizes) if class_sizes else None
+        object_count = storage_metrics.get(f'{query_id}_objects')
+        
+        if total_size_bytes is None or object_count is None:
+            total_size_bytes, object_count = self._list_prefix_parallel(
+                bucket,
+                prefix,
+                partition_chars=datafeed.get('partition_chars', DEFAULT_PARTITION_CHARS)
+            )
+        object_count = int(object_count)
         
         size_gb = total_size_bytes / (1024 ** 3)
         monthly_storage_cost = size_gb * self.pricing['s3']['storage_per_gb_month']
         
-        return {
+        result = {
             'size_gb': round(size_gb, 4),
             'object_count': object_count,
             'monthly_storage_cost': round(monthly_storage_cost, 4)
         }
+        self._storage_cache[(bucket, prefix)] = (time.monotonic(), result)
+        
+        return dict(result)
     
-    def get_s3_request_cost(self, datafeed: Dict, hours: int = 24) -> Dict:
+    def get_s3_request_cost(self, datafeed: Dict, hours: int = 24,
+                            metric_sums: Optional[Dict[str, float]] = None,
+                            query_id: str = 'd0',
+                            metric_costs: Optional[Dict[str, float]] = None) -> Dict:
         """Estimate S3 request costs based on CloudWatch metrics"""
-        bucket = self.config['s3']['bucket']
-        
-        end_time = datetime.utcnow()
-        start_time = end_time - timedelta(hours=hours)
-        
         # Get request metrics (if enabled)
-        put_requests = self._get_cloudwatch_sum(
-            namespace='AWS/S3',
-            metric_name='PutRequests',
-            dimensions=[
-                {'Name': 'BucketName', 'Value': bucket},
-                {'Name': 'FilterId', 'Value': datafeed['name']}
-            ],
-            start_time=start_time,
-            end_time=end_time
-        )
+        if metric_sums is None:
+            metric_sums = self._get_metric_sums(
+                self._datafeed_metric_queries(query_id, datafeed, self._metric_period(hours)),
+                *self._window(hours)
+            )
+        if metric_costs is None:
+            metric_costs = self._price_metric_sums(metric_sums)
         
-        get_requests = self._get_cloudwatch_sum(
-            namespace='AWS/S3',
-            metric_name='GetRequests',
-            dimensions=[
-                {'Name': 'BucketName', 'Value': bucket},
-                {'Name': 'FilterId', 'Value': datafeed['name']}
-            ],
-            start_time=start_time,
-            end_time=end_time
-        )
+        put_requests = metric_sums.get(f'{query_id}_put', 0.0)
+        get_requests = metric_sums.get(f'{query_id}_get', 0.0)
         
-        put_cost = (put_requests / 1000) * self.pricing['s3']['put_request_per_1000']
-        get_cost = (get_requests / 1000) * self.pricing['s3']['get_request_per_1000']
+        put_cost = metric_costs.get(f'{query_id}_put', 0.0)
+        get_cost = metric_costs.get(f'{query_id}_get', 0.0)
         
         return {
             'put_requests': int(put_requests),
@@ -86,45 +382,34 @@ class CostCalculator:
             'total_request_cost': round(put_cost + get_cost, 4)
         }
 
-    def get_lambda_cost(self, function_config: Dict, hours: int = 24) -> Dict:
+    def get_lambda_cost(self, function_config: Dict, hours: int = 24,
+                        metric_sums: Optional[Dict[str, float]] = None,
+                        query_id: str = 'f0',
+                        metric_costs: Optional[Dict[str, float]] = None) -> Dict:
         """Calculate Lambda costs for a function"""
         function_name = function_config['name']
         
-        end_time = datetime.utcnow()
-        start_time = end_time - timedelta(hours=hours)
-        
-        # Get invocation count
-        invocations = self._get_cloudwatch_sum(
-            namespace='AWS/Lambda',
-            metric_name='Invocations',
-            dimensions=[{'Name': 'FunctionName', 'Value': function_name}],
-            start_time=start_time,
-            end_time=end_time
-        )
+        if metric_sums is None:
+            metric_sums = self._get_metric_sums(
+                self._function_metric_queries(
+                    query_id, function_config, self._metric_period(hours)
+                ),
+                *self._window(hours)
+            )
+        if metric_costs is None:
+            metric_costs = self._price_metric_sums(metric_sums)
         
-        # Get duration (milliseconds)
-        duration_ms = self._get_cloudwatch_sum(
-            namespace='AWS/Lambda',
-            metric_name='Duration',
-            dimensions=[{'Name': 'FunctionName', 'Value': function_name}],
-            start_time=start_time,
-            end_time=end_time
-        )
+        # Invocation count and duration (milliseconds)
+        invocations = metric_sums.get(f'{query_id}_inv', 0.0)
+        duration_ms = metric_sums.get(f'{query_id}_dur', 0.0)
         
-        # Get memory size
-        try:
-            response = self.lambda_client.get_function_configuration(
-                FunctionName=function_name
-            )
-            memory_mb = response['MemorySize']
-        except Exception:
-            memory_mb = 128  # Default
+        memory_mb = self._get_lambda_memory(function_name)
         
         # Calculate costs
-        invocation_cost = (invocations / 1_000_000) * self.pricing['lambda']['request_per_million']
+        invocation_cost = metric_costs.get(f'{query_id}_inv', 0.0)
         
         gb_seconds = (duration_ms / 1000) * (memory_mb / 1024)
-        compute_cost = gb_seconds * self.pricing['lambda']['duration_per_gb_second']
+        compute_cost = metric_costs.get(f'{query_id}_dur', 0.0) * (memory_mb / 1024)
         
         return {
             'invocations': int(invocations),
@@ -133,72 +418,476 @@ class CostCalculator:
             'gb_seconds': round(gb_seconds, 4),
             'invocation_cost': round(invocation_cost, 4),
             'compute_cost': round(compute_cost, 4),
-            'total_lambda_cost': round(invocation_cost + compute_cost, 4)
+            'total_lambda_cost': round(invocation_cost + compute_cost, 4),
+            'metrics': self._extra_metric_sums('function', query_id, metric_sums)
         }
     
-    def get_datafeed_costs(self, hours: int = 24) -> List[Dict]:
+    def get_datafeed_costs(self, hours: int = 24,
+                           snapshot: Optional[CostSnapshot] = None) -> List[Dict]:
         """Calculate total costs per datafeed"""
-        results = []
+        return asyncio.run(self.aget_datafeed_costs(hours, snapshot))
+    
+    async def aget_datafeed_costs(self, hours: int = 24,
+                                  snapshot: Optional[CostSnapshot] = None) -> List[Dict]:
+        """Calculate total costs per datafeed with all AWS calls in flight together
         
-        for datafeed in self.config['s3']['datafeeds']:
-            datafeed_name = datafeed['name']
-            
-            # S3 costs
-            s3_storage = self.get_s3_storage_cost(datafeed)
-            s3_requests = self.get_s3_request_cost(datafeed, hours)
-            
-            # Lambda costs
-            lambda_functions = [
-                f for f in self.config['lambda']['functions']
-                if f['datafeed'] == datafeed_name
-            ]
-            
-            lambda_total_cost = 0
-            lambda_details = []
-            for func in lambda_functions:
-                lambda_cost = self.get_lambda_cost(func, hours)
-                lambda_total_cost += lambda_cost['total_lambda_cost']
-                lambda_details.append({
-                    'function': func['name'],
-                    **lambda_cost
-                })
-            
-            # Aggregate costs
-            total_cost = (
-                s3_storage['monthly_storage_cost'] / 30 * (hours / 24) +  # Prorated storage
-                s3_requests['total_request_cost'] +
-                lambda_total_cost
+        A given snapshot is refilled in place with the same costs.
+        """
+        datafeeds = self.config['s3']['datafeeds']
+        loop = asyncio.get_running_loop()
+        if snapshot is not None:
+            snapshot.reset([datafeed['name'] for datafeed in datafeeds], hours)
+        
+        # One window end for every metric of this refresh
+        _, end_time = self._window(hours)
+        
+        # Decide once which storage totals are still cached, so a TTL expiring
+        # mid-refresh can't send a datafeed without metrics to a listing
+        cached_storage = [self._cached_storage_cost(datafeed) for datafeed in datafeeds]
+        storage_queries = [
+            query
+            for cached, queries in zip(cached_storage, self._storage_queries)
+            if cached is None
+            for query in queries
+        ]
+        
+        # botocore clients are blocking but thread-safe, so each call is
+        # awaited on a worker thread
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # All CloudWatch metrics for this refresh in as few requests as possible
+            (metric_sums, fetched_ids), storage_metrics = await asyncio.gather(
+                loop.run_in_executor(
+                    executor, self._get_window_sums,
+                    self._active_metric_queries(self._collect_metric_queries(HISTORY_PERIOD)),
+                    end_time, hours
+                ),
+                loop.run_in_executor(
+                    executor, self._get_storage_metrics, storage_queries, end_time
+                )
             )
+            self._track_cold_queries(metric_sums, fetched_ids)
+            metric_costs = self._price_metric_sums(metric_sums)
             
-            results.append({
-                'datafeed': datafeed_name,
-                'period_hours': hours,
-                's3_storage': s3_storage,
-                's3_requests': s3_requests,
-                'lambda_details': lambda_details,
-                'lambda_total_cost': round(lambda_total_cost, 4),
-                'total_cost': round(total_cost, 4)
+            results = await asyncio.gather(*[
+                self._aprocess_datafeed(
+                    executor, i, datafeed, hours, metric_sums, metric_costs,
+                    storage_metrics, cached_storage[i], snapshot
+                )
+                for i, datafeed in enumerate(datafeeds)
+            ])
+        
+        return list(results)
+    
+    async def _aprocess_datafeed(self, executor: ThreadPoolExecutor, index: int,
+                                 datafeed: Dict, hours: int,
+                                 metric_sums: Dict[str, float],
+                                 metric_costs: Dict[str, float],
+                                 storage_metrics: Dict[str, float],
+                                 cached_storage: Optional[Dict] = None,
+                                 snapshot: Optional[CostSnapshot] = None) -> Dict:
+        """Calculate total costs for a single datafeed"""
+        loop = asyncio.get_running_loop()
+        datafeed_name = datafeed['name']
+        
+        # Lambda functions of this datafeed
+        lambda_functions = self._funcs_by_feed.get(datafeed_name, [])
+        
+        if cached_storage is not None:
+            storage_call = asyncio.sleep(0, cached_storage)
+        else:
+            storage_call = loop.run_in_executor(
+                executor, self.get_s3_storage_cost, datafeed, storage_metrics, f'd{index}'
+            )
+        
+        # S3 storage and Lambda lookups may hit AWS, run them concurrently
+        s3_storage, *lambda_costs = await asyncio.gather(
+            storage_call,
+            *[
+                loop.run_in_executor(
+                    executor, self.get_lambda_cost,
+                    func, hours, metric_sums, f'f{j}', metric_costs
+                )
+                for j, func in lambda_functions
+            ]
+        )
+        s3_requests = self.get_s3_request_cost(
+            datafeed, hours, metric_sums, query_id=f'd{index}', metric_costs=metric_costs
+        )
+        
+        lambda_total_cost = 0
+        lambda_details = []
+        for (_, func), lambda_cost in zip(lambda_functions, lambda_costs):
+            lambda_total_cost += lambda_cost['total_lambda_cost']
+            lambda_details.append({
+                'function': func['name'],
+                **lambda_cost
             })
         
-        return results
+        # Aggregate costs
+        total_cost = (
+            s3_storage['monthly_storage_cost'] / 30 * (hours / 24) +  # Prorated storage
+            s3_requests['total_request_cost'] +
+            lambda_total_cost
+        )
+        
+        result = {
+            'datafeed': datafeed_name,
+            'period_hours': hours,
+            's3_storage': s3_storage,
+            's3_requests': s3_requests,
+            'lambda_details': lambda_details,
+            'lambda_total_cost': round(lambda_total_cost, 4),
+            'total_cost': round(total_cost, 4),
+            'metrics': self._extra_metric_sums('datafeed', f'd{index}', metric_sums)
+        }
+        if snapshot is not None:
+            snapshot.set_row(index, result)
+        
+        return result
+    
+    def _price_metric_sums(self, metric_sums: Dict[str, float]) -> Dict[str, float]:
+        """Apply unit pricing to every priced metric sum in one pass"""
+        costs = {}
+        for query_id, value in metric_sums.items():
+            field_name = query_id.rsplit('_', 1)[-1]
+            if field_name in self._unit_prices:
+                units, price = self._unit_prices[field_name]
+                costs[query_id] = (value / units) * price
+        return costs
+    
+    def _extra_metric_sums(self, scope: str, query_id: str,
+                           metric_sums: Dict[str, float]) -> Dict[str, float]:
+        """Sums of the configured metrics added beyond the priced defaults"""
+        return {
+            key: metric_sums.get(f'{query_id}_{key}', 0.0)
+            for key, metric in self.metrics.items()
+            if metric['scope'] == scope and key not in DEFAULT_METRICS
+        }
+    
+    def _cached_storage_cost(self, datafeed: Dict) -> Optional[Dict]:
+        """Copy of a datafeed's cached storage totals, None once past the TTL"""
+        cached = self._storage_cache.get((self.config['s3']['bucket'], datafeed['prefix']))
+        if cached and time.monotonic() - cached[0] < self.cache_ttl['storage']:
+            return dict(cached[1])
+        return None
     
-    def _get_cloudwatch_sum(self, namespace: str, metric_name: str, 
-                           dimensions: List[Dict], start_time: datetime, 
-                           end_time: datetime) -> float:
-        """Helper to get sum of CloudWatch metric"""
+    def _get_lambda_memory(self, function_name: str) -> int:
+        """Memory size of a Lambda function, cached for the configured TTL"""
+        cached = self._memory_cache.get(function_name)
+        if cached and time.monotonic() - cached[0] < self.cache_ttl['lambda_memory']:
+            return cached[1]
+        
         try:
-            response = self.cloudwatch.get_metric_statistics(
-                Namespace=namespace,
-                MetricName=metric_name,
-                Dimensions=dimensions,
-                StartTime=start_time,
-                EndTime=end_time,
-                Period=3600,  # 1 hour
-                Statistics=['Sum']
+            response = self.lambda_client.get_function_configuration(
+                FunctionName=function_name
+            )
+            memory_mb = response['MemorySize']
+        except Exception:
+            return 128  # Default, retried on the next refresh
+        
+        self._memory_cache[function_name] = (time.monotonic(), memory_mb)
+        return memory_mb
+    
+    def _list_prefix_parallel(self, bucket: str, prefix: str,
+                              partition_chars: str = DEFAULT_PARTITION_CHARS) -> Tuple[int, int]:
+        """Total size and count of objects under a prefix, listed concurrently
+        
+        The key space after the first page is split at ``prefix + c`` for each
+        partition character and every range is listed on the shared listing
+        pool, so keys that don't start with a partition character are still
+        counted exactly once.
+        """
+        first_page = self.s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix)
+        contents = first_page.get('Contents', [])
+        first_size = sum(obj['Size'] for obj in contents)
+        if not first_page.get('IsTruncated'):
+            return first_size, len(contents)
+        
+        last_key = contents[-1]['Key']
+        boundaries = [
+            boundary
+            for boundary in (prefix + c for c in sorted(set(partition_chars)))
+            if boundary > last_key
+        ]
+        key_ranges = zip([last_key] + boundaries, boundaries + [None])
+        
+        totals = list(self._list_executor.map(
+            lambda key_range: self._list_key_range(bucket, prefix, *key_range),
+            key_ranges
+        ))
+        
+        return (
+            first_size + sum(size for size, _ in totals),
+            len(contents) + sum(count for _, count in totals)
+        )
+    
+    def _list_key_range(self, bucket: str, prefix: str, start_after: Optional[str],
+                        stop_at: Optional[str]) -> Tuple[int, int]:
+        """Total size and count of objects with start_after < key <= stop_at"""
+        total_size_bytes = 0
+        object_count = 0
+        
+        params = {'Bucket': bucket, 'Prefix': prefix}
+        if start_after is not None:
+            params['StartAfter'] = start_after
+        
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(**params, PaginationConfig={'PageSize': 1000})
+        
+        # Project only the fields needed; pages without Contents yield None
+        if stop_at is None:
+            sizes = [size for size in pages.search('Contents[].Size') if size is not None]
+            return sum(sizes), len(sizes)
+        
+        for item in pages.search('Contents[].[Key, Size]'):
+            if item is None:
+                continue
+            key, size = item
+            # Keys are listed in order, so the rest belong to the next range
+            if key > stop_at:
+                break
+            total_size_bytes += size
+            object_count += 1
+        
+        return total_size_bytes, object_count
+    
+    def _collect_metric_queries(self, period: int = HISTORY_PERIOD) -> List[Dict]:
+        """GetMetricData queries for every datafeed and Lambda function"""
+        if period in self._metric_queries:
+            return self._metric_queries[period]
+        
+        queries = []
+        for i, datafeed in enumerate(self.config['s3']['datafeeds']):
+            queries.extend(self._datafeed_metric_queries(f'd{i}', datafeed, period))
+        for j, func in enumerate(self.config['lambda']['functions']):
+            queries.extend(self._function_metric_queries(f'f{j}', func, period))
+        
+        self._metric_queries[period] = queries
+        return queries
+    
+    @staticmethod
+    def _metric_period(hours: int) -> int:
+        """Coarsest standard period not longer than the window"""
+        window_seconds = hours * 3600
+        return max((p for p in METRIC_PERIODS if p <= window_seconds), default=METRIC_PERIODS[0])
+    
+    def _datafeed_metric_queries(self, query_id: str, datafeed: Dict,
+                                 period: int = 3600) -> List[Dict]:
+        """Metric queries scoped to a datafeed, e.g. its S3 request metrics"""
+        context = {
+            'bucket': self.config['s3']['bucket'],
+            'datafeed': datafeed['name'],
+            'prefix': datafeed['prefix']
+        }
+        return self._scoped_metric_queries('datafeed', query_id, context, period)
+    
+    def _function_metric_queries(self, query_id: str, function_config: Dict,
+                                 period: int = 3600) -> List[Dict]:
+        """Metric queries scoped to a Lambda function"""
+        context = {
+            'bucket': self.config['s3']['bucket'],
+            'datafeed': function_config['datafeed'],
+            'function': function_config['name']
+        }
+        return self._scoped_metric_queries('function', query_id, context, period)
+    
+    def _scoped_metric_queries(self, scope: str, query_id: str, context: Dict[str, str],
+                               period: int) -> List[Dict]:
+        """One query per configured metric of a scope, dimensions filled in"""
+        return [
+            self._metric_query(
+                f'{query_id}_{key}',
+                metric['namespace'],
+                metric['name'],
+                [
+                    {'Name': name, 'Value': template.format(**context)}
+                    for name, template in metric['dimensions'].items()
+                ],
+                period,
+                metric['stat']
             )
+            for key, metric in self.metrics.items()
+            if metric['scope'] == scope
+        ]
+    
+    def _storage_metric_queries(self, query_id: str, datafeed: Dict) -> List[Dict]:
+        """Daily S3 storage metric queries for a datafeed's `storage_metrics` source
+        
+        Datafeeds without one get no queries and are always listed.
+        """
+        source = datafeed.get('storage_metrics')
+        if source is None:
+            return []
+        if source not in STORAGE_METRIC_SOURCES:
+            raise ValueError(
+                f"Datafeed {datafeed['name']!r} has unknown storage_metrics source {source!r}"
+            )
+        bucket = self.config['s3']['bucket']
+        
+        def dimensions(storage_type: str) -> List[Dict]:
+            return [
+                {'Name': 'BucketName', 'Value': bucket},
+                {'Name': 'StorageType', 'Value': storage_type}
+            ]
+        
+        return [
+            *(
+                self._metric_query(f'{query_id}_size{k}', 'AWS/S3', 'BucketSizeBytes',
+                                   dimensions(storage_type), period=86400, stat='Average')
+                for k, storage_type in enumerate(STORAGE_SIZE_TYPES)
+            ),
+            self._metric_query(f'{query_id}_objects', 'AWS/S3', 'NumberOfObjects',
+                               dimensions('AllStorageTypes'), period=86400, stat='Average')
+        ]
+    
+    @staticmethod
+    def _metric_query(query_id: str, namespace: str, metric_name: str,
+                      dimensions: List[Dict], period: int = 3600,
+                      stat: str = 'Sum') -> Dict:
+        """Helper to build a single MetricDataQuery"""
+        return {
+            'Id': query_id,
+            'MetricStat': {
+                'Metric': {
+                    'Namespace': namespace,
+                    'MetricName': metric_name,
+                    'Dimensions': dimensions
+                },
+                'Period': period,
+                'Stat': stat
+            },
+            'ReturnData': True
+        }
+    
+    def _active_metric_queries(self, queries: List[Dict]) -> List[Dict]:
+        """Drop queries that are backed off this refresh; they count as zero"""
+        active = []
+        for query in queries:
+            skips_left = self._skips_left.get(query['Id'], 0)
+            if skips_left:
+                self._skips_left[query['Id']] = skips_left - 1
+            else:
+                active.append(query)
+        return active
+    
+    def _track_cold_queries(self, metric_sums: Dict[str, float], fetched_ids: Set[str]) -> None:
+        """Back off queries whose sums keep coming back zero
+        
+        Only queries fetched this refresh count, so a failed fetch isn't taken
+        for a cold metric.
+        """
+        for query_id in fetched_ids:
+            if metric_sums[query_id]:
+                self._zero_streaks.pop(query_id, None)
+                continue
+            
+            streak = self._zero_streaks.get(query_id, 0) + 1
+            self._zero_streaks[query_id] = streak
+            if self.cold_query_threshold and streak >= self.cold_query_threshold:
+                self._skips_left[query_id] = min(
+                    2 ** (streak - self.cold_query_threshold), self.cold_query_max_skip
+                )
+    
+    @staticmethod
+    def _window(hours: int) -> Tuple[datetime, datetime]:
+        """Start and end of a lookback window ending now, in UTC"""
+        end_time = datetime.now(timezone.utc).replace(microsecond=0)
+        return end_time - timedelta(hours=hours), end_time
+    
+    def _get_window_sums(self, queries: List[Dict], end_time: datetime,
+                         hours: int) -> Tuple[Dict[str, float], Set[str]]:
+        """Sum metrics over the last `hours` settled hourly buckets, fetching only new ones
+        
+        The hour in progress is left out, so the window always spans `hours`
+        full hours, the same span storage is prorated over. Also returns the
+        Ids of the queries that were fetched successfully.
+        """
+        period = timedelta(seconds=HISTORY_PERIOD)
+        current_bucket = end_time.replace(minute=0, second=0, microsecond=0)
+        first_bucket = current_bucket - period * hours
+        resume_bucket = current_bucket - period * HISTORY_LATE_BUCKETS
+        
+        with self._history_lock:
+            if hours != self._history_hours:
+                self._metric_history.clear()
+                self._history_fetched.clear()
+                self._history_hours = hours
             
-            total = sum(point['Sum'] for point in response['Datapoints'])
-            return total
-        except Exception as e:
-            print(f"Warning: Could not fetch {metric_name}: {e}")
-            return 0.0
+            # The newest settled buckets may have received late datapoints, so
+            # those are fetched again. Backed off queries keep their buckets and
+            # only catch up on what they missed.
+            queries_by_start: Dict[datetime, List[Dict]] = defaultdict(list)
+            for query in queries:
+                fetch_start = max(self._history_fetched.get(query['Id'], first_bucket), first_bucket)
+                queries_by_start[fetch_start].append(query)
+            
+            sums = {}
+            fetched_ids = set()
+            for fetch_start, start_queries in queries_by_start.items():
+                if fetch_start < current_bucket:
+                    series = self._get_metric_series(start_queries, fetch_start, current_bucket)
+                else:
+                    series = {}
+                for query in start_queries:
+                    query_id = query['Id']
+                    buckets = self._metric_history.setdefault(query_id, deque(maxlen=max(hours, 0)))
+                    # Failed fetches keep the previous buckets and are retried next time
+                    if query_id in series:
+                        while buckets and buckets[-1][0] >= fetch_start:
+                            buckets.pop()
+                        buckets.extend(
+                            point for point in series[query_id] if point[0] < current_bucket
+                        )
+                        self._history_fetched[query_id] = resume_bucket
+                        fetched_ids.add(query_id)
+                    while buckets and buckets[0][0] < first_bucket:
+                        buckets.popleft()
+                    sums[query_id] = sum((value for _, value in buckets), 0.0)
+        
+        return sums, fetched_ids
+    
+    def _get_metric_sums(self, queries: List[Dict], start_time: datetime,
+                         end_time: datetime) -> Dict[str, float]:
+        """Helper to sum CloudWatch metrics for many queries via GetMetricData"""
+        series = self._get_metric_series(queries, start_time, end_time)
+        return {
+            query['Id']: sum((value for _, value in series.get(query['Id'], [])), 0.0)
+            for query in queries
+        }
+    
+    def _get_storage_metrics(self, queries: List[Dict],
+                             end_time: datetime) -> Dict[str, float]:
+        """Latest daily value of each storage metric query that has data"""
+        series = self._get_metric_series(
+            queries, end_time - STORAGE_METRICS_LOOKBACK, end_time
+        )
+        return {query_id: points[-1][1] for query_id, points in series.items() if points}
+    
+    def _get_metric_series(self, queries: List[Dict], start_time: datetime,
+                           end_time: datetime) -> Dict[str, List[Tuple[datetime, float]]]:
+        """Helper to fetch CloudWatch datapoints, oldest first, via GetMetricData
+        
+        Queries in a batch that failed to fetch are left out of the result.
+        """
+        series = {}
+        paginator = self.cloudwatch.get_paginator('get_metric_data')
+        for offset in range(0, len(queries), MAX_METRIC_DATA_QUERIES):
+            chunk = queries[offset:offset + MAX_METRIC_DATA_QUERIES]
+            chunk_series = {query['Id']: [] for query in chunk}
+            try:
+                for page in paginator.paginate(
+                    MetricDataQueries=chunk,
+                    StartTime=start_time,
+                    EndTime=end_time,
+                    ScanBy='TimestampAscending'
+                ):
+                    for result in page['MetricDataResults']:
+                        chunk_series[result['Id']].extend(
+                            zip(result['Timestamps'], result['Values'])
+                        )
+            except Exception as e:
+                print(f"Warning: Could not fetch CloudWatch metrics: {e}")
+                continue
+            series.update(chunk_series)
+        
+        return series
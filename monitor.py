@@ -3,102 +3,141 @@ Real-time Cost Monitor
 Continuously monitors and displays ETL pipeline costs per datafeed
 """
 
+import asyncio
+import math
 import time
 import os
-from datetime import datetime
+import sys
+from datetime import datetime, timezone
 from tabulate import tabulate
-from cost_calculator import CostCalculator
+from cost_calculator import CostSnapshot, get_calculator
+
+
+# ANSI erase display + cursor home
+CLEAR_SCREEN = '\x1b[2J\x1b[H'
 
 
 class CostMonitor:
     def __init__(self, config_path: str = 'config.yaml'):
-        self.calculator = CostCalculator(config_path)
-        with open(config_path, 'r') as f:
-            import yaml
-            self.config = yaml.safe_load(f)
+        self.calculator = get_calculator(config_path)
+        self.config = self.calculator.config
     
-    def display_costs(self, costs_data):
+    def display_costs(self, costs_data, snapshot=None):
         """Display costs in a formatted table"""
-        os.system('clear' if os.name == 'posix' else 'cls')
+        if snapshot is None:
+            snapshot = CostSnapshot.from_costs(costs_data)
         
-        print("=" * 80)
-        print(f"ETL Pipeline Cost Monitor - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        print("=" * 80)
-        print()
+        # Only clear real terminals so redirected output stays clean
+        clear = CLEAR_SCREEN if sys.stdout.isatty() else ""
+        
+        lines = ["=" * 80]
+        lines.append(f"ETL Pipeline Cost Monitor - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+        lines.append("=" * 80)
+        lines.append("")
         
         # Summary table
-        summary_data = []
-        for datafeed in costs_data:
-            summary_data.append([
-                datafeed['datafeed'],
-                f"${datafeed['s3_storage']['size_gb']:.2f} GB",
-                datafeed['s3_storage']['object_count'],
-                f"${datafeed['s3_requests']['total_request_cost']:.4f}",
-                f"${datafeed['lambda_total_cost']:.4f}",
-                f"${datafeed['total_cost']:.4f}"
-            ])
+        summary_data = [
+            [name, f"${size_gb:.2f} GB", objects, f"${requests:.4f}",
+             f"${lambda_cost:.4f}", f"${total:.4f}"]
+            for name, size_gb, objects, requests, lambda_cost, total in zip(
+                snapshot.names, snapshot.size_gb, snapshot.object_count,
+                snapshot.request_cost, snapshot.lambda_cost, snapshot.total_cost
+            )
+        ]
         
-        print("COST SUMMARY (Last 24 Hours)")
-        print(tabulate(
+        lines.append("COST SUMMARY (Last 24 Hours)")
+        lines.append(tabulate(
             summary_data,
             headers=['Datafeed', 'Storage', 'Objects', 'S3 Requests', 'Lambda', 'Total Cost'],
             tablefmt='grid'
         ))
-        print()
+        lines.append("")
         
         # Detailed breakdown
         for datafeed in costs_data:
-            print(f"\n{datafeed['datafeed'].upper()} - DETAILED BREAKDOWN")
-            print("-" * 80)
+            lines.append(f"\n{datafeed['datafeed'].upper()} - DETAILED BREAKDOWN")
+            lines.append("-" * 80)
             
             # S3 Details
             s3_storage = datafeed['s3_storage']
             s3_requests = datafeed['s3_requests']
-            print(f"  S3 Storage:")
-            print(f"    Size: {s3_storage['size_gb']:.4f} GB")
-            print(f"    Objects: {s3_storage['object_count']}")
-            print(f"    Monthly Storage Cost: ${s3_storage['monthly_storage_cost']:.4f}")
-            print(f"  S3 Requests:")
-            print(f"    PUT: {s3_requests['put_requests']} (${s3_requests['put_cost']:.4f})")
-            print(f"    GET: {s3_requests['get_requests']} (${s3_requests['get_cost']:.4f})")
+            lines.append("  S3 Storage:")
+            lines.append(f"    Size: {s3_storage['size_gb']:.4f} GB")
+            lines.append(f"    Objects: {s3_storage['object_count']}")
+            lines.append(f"    Monthly Storage Cost: ${s3_storage['monthly_storage_cost']:.4f}")
+            lines.append("  S3 Requests:")
+            lines.append(f"    PUT: {s3_requests['put_requests']} (${s3_requests['put_cost']:.4f})")
+            lines.append(f"    GET: {s3_requests['get_requests']} (${s3_requests['get_cost']:.4f})")
             
             # Lambda Details
-            print(f"  Lambda Functions:")
+            lines.append("  Lambda Functions:")
             for func in datafeed['lambda_details']:
-                print(f"    {func['function']}:")
-                print(f"      Invocations: {func['invocations']}")
-                print(f"      Duration: {func['duration_ms']:.2f} ms")
-                print(f"      Memory: {func['memory_mb']} MB")
-                print(f"      GB-Seconds: {func['gb_seconds']:.4f}")
-                print(f"      Cost: ${func['total_lambda_cost']:.4f}")
+                lines.append(f"    {func['function']}:")
+                lines.append(f"      Invocations: {func['invocations']}")
+                lines.append(f"      Duration: {func['duration_ms']:.2f} ms")
+                lines.append(f"      Memory: {func['memory_mb']} MB")
+                lines.append(f"      GB-Seconds: {func['gb_seconds']:.4f}")
+                lines.append(f"      Cost: ${func['total_lambda_cost']:.4f}")
         
         # Total across all datafeeds
-        total_all = sum(d['total_cost'] for d in costs_data)
-        print("\n" + "=" * 80)
-        print(f"TOTAL COST (All Datafeeds): ${total_all:.4f}")
-        print("=" * 80)
+        total_all = snapshot.total()
+        lines.append("\n" + "=" * 80)
+        lines.append(f"TOTAL COST (All Datafeeds): ${total_all:.4f}")
+        lines.append("=" * 80)
+        
+        # One write for the whole frame instead of a print per line
+        sys.stdout.write(clear + "\n".join(lines) + "\n")
+        sys.stdout.flush()
     
     def run(self):
         """Run the monitor continuously"""
         refresh_interval = self.config['monitoring']['refresh_interval_seconds']
         lookback_hours = self.config['monitoring']['lookback_hours']
+        history_csv = self.config['monitoring'].get('history_csv')
+        
+        if os.name == 'nt':
+            os.system('')  # Enables ANSI escape handling in the Windows console
         
         print("Starting ETL Pipeline Cost Monitor...")
         print(f"Refresh interval: {refresh_interval} seconds")
         print(f"Lookback period: {lookback_hours} hours")
         print()
         
+        # Columns are refilled in place on every refresh
+        snapshot = CostSnapshot()
+        
         try:
+            # Refreshes are scheduled on a fixed monotonic cadence, so slow
+            # refreshes don't stretch the period between them
+            next_tick = time.monotonic()
             while True:
+                next_tick += refresh_interval
                 try:
-                    costs_data = self.calculator.get_datafeed_costs(hours=lookback_hours)
-                    self.display_costs(costs_data)
-                    print(f"\nNext refresh in {refresh_interval} seconds... (Press Ctrl+C to exit)")
-                    time.sleep(refresh_interval)
+                    costs_data = asyncio.run(
+                        self.calculator.aget_datafeed_costs(hours=lookback_hours, snapshot=snapshot)
+                    )
+                    self.display_costs(costs_data, snapshot)
+                    status = "\nNext refresh in {:.0f} seconds... (Press Ctrl+C to exit)"
                 except Exception as e:
                     print(f"Error fetching costs: {e}")
-                    print(f"Retrying in {refresh_interval} seconds...")
-                    time.sleep(refresh_interval)
+                    status = "Retrying in {:.0f} seconds..."
+                else:
+                    if history_csv:
+                        try:
+                            snapshot.append_csv(history_csv, datetime.now(timezone.utc))
+                        except OSError as e:
+                            print(f"Warning: Could not write cost history: {e}")
+                
+                # When a refresh overruns, skip the missed ticks instead of
+                # firing them back to back. A zero interval refreshes
+                # continuously, so there is nothing to skip.
+                overshoot = time.monotonic() - next_tick
+                if refresh_interval > 0 and overshoot > 0:
+                    next_tick += refresh_interval * math.ceil(overshoot / refresh_interval)
+                
+                delay = max(0, next_tick - time.monotonic())
+                print(status.format(delay))
+                time.sleep(delay)
         except KeyboardInterrupt:
             print("\n\nMonitor stopped by user.")
 